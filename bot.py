@@ -1,69 +1,88 @@
+import asyncio
 import logging
 import os
+import re
+from collections import OrderedDict
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import NamedTuple
+from urllib.parse import urlparse
 
 import telegramify_markdown
 from dotenv import load_dotenv
-from telegram import Update
+from telegram import ReplyParameters, Update
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     ContextTypes,
     MessageHandler,
+    TypeHandler,
     filters,
 )
+from telegram.request import HTTPXRequest
 from telegramify_markdown import customize
 
-# Load environment variables from .env file
-load_dotenv()
-
 # Configure logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-# Configuration
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-WHITELIST = (
-    list(map(int, os.getenv("WHITELIST", "").split(",")))
-    if os.getenv("WHITELIST")
-    else []
-)
-
-# Customize telegramify-markdown settings
-config = customize.get_runtime_config()
-config.markdown_symbol.head_level_1 = "📌"
-config.markdown_symbol.head_level_2 = ""
-config.markdown_symbol.head_level_3 = ""
-config.markdown_symbol.head_level_4 = ""
-config.markdown_symbol.link = "🔗"
-config.cite_expandable = True
-
-
-class MarkdownBot:
-    def __init__(self, token: str, whitelist: list):
-        self.token = token
-        self.whitelist = whitelist
-        self.application = Application.builder().token(token).build()
-
-        # Add handlers
-        self.application.add_handler(CommandHandler("start", self.start_command))
-        self.application.add_handler(CommandHandler("help", self.help_command))
-        self.application.add_handler(
-            MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_markdown)
-        )
-
-    async def start_command(
-        self, update: Update, context: ContextTypes.DEFAULT_TYPE
-    ) -> None:
-        """Handle /start command"""
-        user_id = update.effective_user.id
-
-        if user_id not in self.whitelist:
-            logger.info(f"Unauthorized user {user_id} tried to start the bot")
-            return
-
-        welcome_message = """
+# Telegram rejects messages over 4096 characters, leave room for a header
+MAX_CHUNK_LENGTH = 4000
+PART_HEADER = "📄 *Part {}/{}*\n\n"
+# Number of recently formatted messages kept in memory
+FORMAT_CACHE_SIZE = 256
+
+
+class Settings(NamedTuple):
+    bot_token: str | None
+    whitelist: frozenset[int]
+    telegram_api_url: str
+    webhook_url: str | None
+    webhook_port: int
+    webhook_secret: str | None
+    format_workers: int
+
+
+@lru_cache(maxsize=1)
+def _config() -> Settings:
+    """Read the bot configuration from the environment and .env file"""
+    # Load environment variables from .env file
+    load_dotenv()
+
+    whitelist = os.getenv("WHITELIST", "")
+    # Invalid numbers become 0 and are reported by main()
+    webhook_port = os.getenv("WEBHOOK_PORT", "8443").strip()
+    format_workers = os.getenv("FORMAT_WORKERS", "2").strip()
+    return Settings(
+        bot_token=os.getenv("BOT_TOKEN"),
+        whitelist=frozenset(int(x) for x in whitelist.split(",") if x.strip()),
+        telegram_api_url=os.getenv("TELEGRAM_API_URL", "").rstrip("/"),
+        webhook_url=os.getenv("WEBHOOK_URL") or None,
+        webhook_port=int(webhook_port) if webhook_port.isdecimal() else 0,
+        webhook_secret=os.getenv("WEBHOOK_SECRET") or None,
+        format_workers=int(format_workers) if format_workers.isdecimal() else 0,
+    )
+
+
+@lru_cache(maxsize=1)
+def _configure_telegramify() -> None:
+    """Customize telegramify-markdown settings"""
+    config = customize.get_runtime_config()
+    config.markdown_symbol.head_level_1 = "📌"
+    config.markdown_symbol.head_level_2 = ""
+    config.markdown_symbol.head_level_3 = ""
+    config.markdown_symbol.head_level_4 = ""
+    config.markdown_symbol.link = "🔗"
+    config.cite_expandable = True
+
+
+# Static command messages
+WELCOME_RAW = """
 🤖 **Markdown Formatter Bot**
 
 Send me any markdown text and I'll format it for Telegram!
@@ -80,21 +99,10 @@ Supported features:
 • And much more!
 
 Just send me your markdown text and I'll convert it to proper Telegram format.
-        """
-
-        formatted = telegramify_markdown.markdownify(welcome_message.strip())
-        await update.message.reply_text(formatted, parse_mode="MarkdownV2")
-
-    async def help_command(
-        self, update: Update, context: ContextTypes.DEFAULT_TYPE
-    ) -> None:
-        """Handle /help command"""
-        user_id = update.effective_user.id
-
-        if user_id not in self.whitelist:
-            return
+"""
 
-        help_text = """
+# Already escaped for MarkdownV2
+HELP_RAW = """
 📖 **How to use this bot:**
 
 1\\. Send me any markdown text
@@ -120,77 +128,370 @@ This is **bold** and this is *italic*
 • Strikethrough \\~\\~text\\~\\~
 • Spoilers \\|\\|text\\|\\|
 • LaTeX math expressions
-        """
+"""
+HELP_FORMATTED = HELP_RAW
+
+
+@lru_cache(maxsize=1)
+def _welcome_message() -> str:
+    """Format the welcome message on first use"""
+    _configure_telegramify()
+    return telegramify_markdown.markdownify(WELCOME_RAW.strip())
+
+
+# Translation table escaping MarkdownV2 special characters, built once at import
+_MDV2_ESCAPE = str.maketrans({c: "\\" + c for c in r"\_*[]()~`>#+-=|{}.!"})
+
+# Escaped characters and runs of backticks, the latter are code fences
+_FENCE_RE = re.compile(r"\\.|`{3,}", re.DOTALL)
+CODE_FENCE = "```"
+
+
+def _markdownify_sync(text: str) -> str:
+    """Convert markdown to Telegram format (runs in a worker process)"""
+    _configure_telegramify()
+    return telegramify_markdown.markdownify(
+        text, max_line_length=None, normalize_whitespace=False
+    )
+
+
+def _noop(_) -> None:
+    """Do nothing, used to start the worker processes ahead of time"""
+
+
+def _cut(text: str, i: int, j: int, fences: list[tuple[int, int]]) -> int:
+    """Move a cut at j back to a safe position after i"""
+    if j >= len(text):
+        return len(text)
+    for sep in ("\n\n", "\n", " "):
+        k = text.rfind(sep, i, j)
+        if k > i:
+            j = k + len(sep)
+            break
+    # Never cut through a fence
+    for start, end in fences:
+        if start < j < end and start > i:
+            j = start
+    # Don't separate an escape from its character
+    run = j - i - len(text[i:j].rstrip("\\"))
+    if run % 2 == 1 and j - 1 > i:
+        j -= 1
+    return j
+
+
+def _smart_split(text: str, limit: int = MAX_CHUNK_LENGTH) -> Iterator[str]:
+    """Split text into parts of at most limit characters at natural breaks"""
+    fences = [m.span() for m in _FENCE_RE.finditer(text) if m.group()[0] == "`"]
+    # Fences pair up into code blocks, an unmatched last one is left alone
+    blocks = list(zip(fences[0::2], fences[1::2]))
+    reopen = ""
+    i = 0
+    while i < len(text):
+        room = limit - len(reopen)
+        j = _cut(text, i, i + room, fences)
+        block = next(((o, c) for o, c in blocks if o[0] < j <= c[0]), None)
+        if block is None:
+            yield reopen + text[i:j]
+            reopen = ""
+            i = j
+            continue
+
+        opening, closing = block
+        if opening[0] > i:
+            # Keep the code block together by starting the next part with it
+            yield reopen + text[i : opening[0]]
+            reopen = ""
+            i = opening[0]
+            continue
+
+        # The block doesn't fit in one part, close it here and reopen it in
+        # the next one with the same language line
+        j = _cut(text, i, i + room - len(CODE_FENCE), fences)
+        yield reopen + text[i:j] + CODE_FENCE
+        line_end = text.find("\n", opening[1], closing[0])
+        reopen = text[opening[0] : line_end + 1]
+        if line_end == -1 or " " in reopen or len(reopen) > limit // 4:
+            reopen = CODE_FENCE + "\n"
+        i = j
+
+
+def _reply_kwargs(update: Update) -> dict:
+    """Arguments making send_message reply like Message.reply_text"""
+    # Stay in the user's forum topic and quote them outside private chats
+    message = update.effective_message
+    kwargs = {
+        "message_thread_id": (
+            message.message_thread_id if message.is_topic_message else None
+        )
+    }
+    if update.effective_chat.type != "private":
+        kwargs["reply_parameters"] = ReplyParameters(
+            message.message_id, allow_sending_without_reply=True
+        )
+    return kwargs
 
-        await update.message.reply_text(help_text, parse_mode="MarkdownV2")
+
+class MarkdownBot:
+    def __init__(
+        self,
+        token: str,
+        whitelist: frozenset[int],
+        api_url: str | None = None,
+        format_workers: int = 2,
+    ):
+        self.token = token
+        self.whitelist: frozenset[int] = frozenset(whitelist)
+        # Process up to 32 updates at once. Handlers share only the immutable
+        # whitelist and the format cache, which is only touched from the
+        # event loop thread
+        builder = (
+            Application.builder()
+            .token(token)
+            .concurrent_updates(32)
+            # Multiplex concurrent replies over HTTP/2 with a roomy pool
+            .request(
+                HTTPXRequest(
+                    connection_pool_size=100, http_version="2", pool_timeout=5.0
+                )
+            )
+            .get_updates_request(HTTPXRequest(http_version="2"))
+        )
+        if api_url:
+            # Talk to a local Bot API server instead of api.telegram.org
+            builder = (
+                builder.base_url(f"{api_url}/bot")
+                .base_file_url(f"{api_url}/file/bot")
+                .local_mode(True)
+            )
+        self.application = builder.build()
+
+        # Markdown parsing is CPU-bound, keep it off the event loop
+        # (the pool itself is started by run())
+        self._format_workers = format_workers
+        self._executor: ProcessPoolExecutor | None = None
+        # Users often resend the same text, remember recent results
+        self._format_cache: OrderedDict[str, str] = OrderedDict()
+
+        # Add handlers, dropping unauthorized users before any of them run
+        self.application.add_handler(TypeHandler(Update, self._auth_gate), group=-1)
+        self.application.add_handler(CommandHandler("start", self.start_command))
+        self.application.add_handler(CommandHandler("help", self.help_command))
+        self.application.add_handler(
+            MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_markdown)
+        )
+
+    async def _auth_gate(
+        self, update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> None:
+        """Stop processing updates not sent by a whitelisted user"""
+        user = update.effective_user
+        if user is None:
+            # Channel posts and similar updates carry no user to authorize
+            raise ApplicationHandlerStop
+        if user.id not in self.whitelist:
+            logger.info("Unauthorized user %s tried to use the bot", user.id)
+            raise ApplicationHandlerStop
+
+    async def start_command(
+        self, update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> None:
+        """Handle /start command"""
+        await context.bot.send_message(
+            update.effective_chat.id,
+            _welcome_message(),
+            parse_mode="MarkdownV2",
+            **_reply_kwargs(update),
+        )
+
+    async def help_command(
+        self, update: Update, context: ContextTypes.DEFAULT_TYPE
+    ) -> None:
+        """Handle /help command"""
+        await context.bot.send_message(
+            update.effective_chat.id,
+            HELP_FORMATTED,
+            parse_mode="MarkdownV2",
+            **_reply_kwargs(update),
+        )
 
     async def handle_markdown(
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ) -> None:
         """Handle markdown text messages"""
         user_id = update.effective_user.id
-
-        # Check if user is whitelisted
-        if user_id not in self.whitelist:
-            logger.info(f"Unauthorized user {user_id} tried to use the bot")
-            return
+        chat_id = update.effective_chat.id
+        reply = _reply_kwargs(update)
+        send = context.bot.send_message
 
         # Get the message text
         markdown_text = update.message.text
+        # Parts already delivered, reported if a later part fails
+        sent = total = 0
 
         try:
             # Convert markdown to Telegram format
-            formatted_text = telegramify_markdown.markdownify(
-                markdown_text, max_line_length=None, normalize_whitespace=False
+            formatted_text = await self._format(markdown_text)
+
+            if len(formatted_text) <= MAX_CHUNK_LENGTH:
+                await send(
+                    chat_id,
+                    formatted_text,
+                    parse_mode="MarkdownV2",
+                    **reply,
+                )
+                logger.info("Successfully formatted message for user %s", user_id)
+                return
+
+            # Too long for a single Telegram message, send it in parts
+            chunks = list(_smart_split(formatted_text))
+            total = len(chunks)
+
+            for i, chunk in enumerate(chunks):
+                await send(
+                    chat_id,
+                    PART_HEADER.format(i + 1, total) + chunk,
+                    parse_mode="MarkdownV2",
+                    **reply,
+                )
+                sent += 1
+            logger.info(
+                "Successfully formatted and sent %d message chunks for user %s",
+                total,
+                user_id,
             )
 
-            await update.message.reply_text(formatted_text, parse_mode="MarkdownV2")
-            logger.info(f"Successfully formatted message for user {user_id}")
-
         except Exception as e:
-            logger.error(f"Error formatting message: {e}")
+            logger.error("Error formatting message: %s", e)
             # Send error message in a safe format
-            error_text = str(e).replace(".", "\\.")
-            error_msg = (
-                f"❌ Sorry, I couldn't format your message\\. Error: `{error_text}`"
+            error_text = str(e).translate(_MDV2_ESCAPE)
+            if sent:
+                error_msg = (
+                    f"❌ Sorry, only {sent} of {total} parts were sent, "
+                    f"part {sent + 1} failed\\. Error: `{error_text}`"
+                )
+            else:
+                error_msg = (
+                    f"❌ Sorry, I couldn't format your message\\. Error: `{error_text}`"
+                )
+            await send(chat_id, error_msg, parse_mode="MarkdownV2", **reply)
+
+    async def _format(self, text: str) -> str:
+        """Format markdown text in the worker pool, reusing recent results"""
+        cached = self._format_cache.get(text)
+        if cached is not None:
+            self._format_cache.move_to_end(text)
+            return cached
+
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            formatted = await loop.run_in_executor(executor, _markdownify_sync, text)
+        except BrokenProcessPool:
+            # A worker died (OOM kill, crash), replace the pool and retry once
+            if self._executor is executor:
+                logger.warning("Format worker pool is broken, restarting it")
+                executor.shutdown(wait=False)
+                self._start_executor()
+            formatted = await loop.run_in_executor(
+                self._executor, _markdownify_sync, text
             )
-            await update.message.reply_text(error_msg, parse_mode="MarkdownV2")
+        self._format_cache[text] = formatted
+        if len(self._format_cache) > FORMAT_CACHE_SIZE:
+            self._format_cache.popitem(last=False)
+        return formatted
+
+    def _start_executor(self) -> list[Future]:
+        """Create a fresh worker pool and start all of its processes"""
+        self._executor = ProcessPoolExecutor(max_workers=self._format_workers)
+        # Submitting while no worker is idle spawns a new process each time
+        return [self._executor.submit(_noop, None) for _ in range(self._format_workers)]
 
     async def error_handler(
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ) -> None:
         """Handle errors"""
-        logger.error(f"Update {update} caused error {context.error}")
-
-    def run(self):
-        """Start the bot"""
+        logger.error("Update %s caused error %s", update, context.error)
+
+    def run(
+        self,
+        webhook_url: str | None = None,
+        webhook_port: int = 8443,
+        webhook_secret: str | None = None,
+    ):
+        """Start the bot, using a webhook if a URL is given and polling otherwise"""
         # Add error handler
         self.application.add_error_handler(self.error_handler)
 
         logger.info("Starting Markdown Formatter Bot...")
-        logger.info(f"Whitelisted users: {self.whitelist}")
+        logger.info("Whitelisted users: %s", sorted(self.whitelist))
 
-        # Start the bot
-        self.application.run_polling(allowed_updates=Update.ALL_TYPES)
+        try:
+            # Spawn the workers now rather than on the first user's message
+            for future in self._start_executor():
+                future.result()
+
+            # Start the bot
+            if webhook_url:
+                logger.info("Listening for webhook updates on port %d", webhook_port)
+                self.application.run_webhook(
+                    listen="0.0.0.0",
+                    port=webhook_port,
+                    url_path=urlparse(webhook_url).path.lstrip("/"),
+                    secret_token=webhook_secret,
+                    webhook_url=webhook_url,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+            else:
+                self.application.run_polling(allowed_updates=Update.ALL_TYPES)
+        finally:
+            if self._executor:
+                self._executor.shutdown()
 
 
 def main():
+    settings = _config()
+
     # Validate configuration
-    if not BOT_TOKEN:
+    if not settings.bot_token:
         print("❌ Please set your BOT_TOKEN in the .env file!")
         print("Get your bot token from @BotFather on Telegram")
         print("Create a .env file with: BOT_TOKEN=your_token_here")
         return
 
-    if not WHITELIST:
+    if not settings.whitelist:
         print("❌ Please add user IDs to the WHITELIST in the .env file!")
         print("You can get your user ID by messaging @userinfobot on Telegram")
         print("Add to .env file: WHITELIST=123456789,987654321")
         return
 
+    if settings.format_workers < 1:
+        print("❌ FORMAT_WORKERS in the .env file must be a positive integer!")
+        print("Remove it to use the default of 2 worker processes")
+        print("Add to .env file: FORMAT_WORKERS=2")
+        return
+
+    if not 0 < settings.webhook_port < 65536:
+        print("❌ WEBHOOK_PORT in the .env file must be a port number!")
+        print("Remove it to use the default port 8443")
+        print("Add to .env file: WEBHOOK_PORT=8443")
+        return
+
+    # Use uvloop's faster event loop when it is installed, run() picks it up
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop(uvloop.new_event_loop())
+
     # Create and run bot
-    bot = MarkdownBot(BOT_TOKEN, WHITELIST)
-    bot.run()
+    bot = MarkdownBot(
+        settings.bot_token,
+        settings.whitelist,
+        settings.telegram_api_url,
+        settings.format_workers,
+    )
+    bot.run(settings.webhook_url, settings.webhook_port, settings.webhook_secret)
 
 
 if __name__ == "__main__":
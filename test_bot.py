@@ -0,0 +1,68 @@
+from bot import MAX_CHUNK_LENGTH, _smart_split
+
+
+def _check(text: str, limit: int = MAX_CHUNK_LENGTH) -> list[str]:
+    parts = list(_smart_split(text, limit))
+    assert "".join(parts) == text
+    assert all(0 < len(part) <= limit for part in parts)
+    for part in parts:
+        run = len(part) - len(part.rstrip("\\"))
+        assert run % 2 == 0
+    return parts
+
+
+def test_short_text_is_one_part():
+    assert _check("hello") == ["hello"]
+
+
+def test_splits_at_paragraph_then_line_then_word():
+    text = "a" * 10 + "\n\n" + "b" * 10 + "\n" + "c c c"
+    assert _check(text, 12) == ["a" * 10 + "\n\n", "b" * 10 + "\n", "c c c"]
+
+
+def test_words_stay_whole():
+    parts = _check("word " * 3000)
+    assert all(part.endswith(" ") for part in parts)
+
+
+def test_hard_cut_keeps_escape_with_its_character():
+    assert _check("abc\\.def", 4) == ["abc", "\\.de", "f"]
+
+
+def test_escaped_backslashes_do_not_make_tiny_parts():
+    parts = _check("\\\\" * 2500)
+    assert len(parts) == 2
+
+
+def test_code_block_is_kept_together():
+    block = "```\n" + "x = 1\n" * 5 + "```\n"
+    parts = _check("intro\n" * 5 + block, 60)
+    assert all(part.count("```") % 2 == 0 for part in parts)
+    assert block in parts[-1]
+
+
+def test_fence_step_back_keeps_escape_with_its_character():
+    _check("aaaaa\\```code```" + "b" * 20, 10)
+
+
+def test_escaped_backtick_does_not_open_a_fence():
+    assert _check("aa \\```bb cc dd", 10) == ["aa \\```bb ", "cc dd"]
+
+
+def test_never_cuts_inside_a_fence():
+    parts = _check("aaaa\\\\```" + "b" * 13, 8)
+    assert parts[0] == "aaaa\\\\"
+    assert parts[1].startswith("```")
+
+
+def test_long_code_block_is_closed_and_reopened():
+    opening = "```python\n"
+    block = opening + "x = 1\n" * 20 + "```\n"
+    parts = list(_smart_split(block, 40))
+    assert len(parts) > 1
+    assert all(len(part) <= 40 for part in parts)
+    assert all(part.count("```") == 2 for part in parts)
+    assert all(part.startswith(opening) for part in parts)
+    body = [part.removesuffix("```") for part in parts[:-1]] + [parts[-1]]
+    body = [body[0]] + [part.removeprefix(opening) for part in body[1:]]
+    assert "".join(body) == block